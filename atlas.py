@@ -0,0 +1,121 @@
+import numpy as np
+import sys
+import h5py
+
+from data_conditioner import edge_energies
+
+"""
+Offline stage for precomputing the solution atlas used by ``HXRSatt``.
+
+For every photon energy bin over the operating range the atlas stores
+the order of all filter configurations sorted by increasing
+transmission.  Bins are split at every absorption edge of the blade
+materials, where the order changes abruptly.  The order is written to a contiguous (unchunked) HDF5
+dataset so it can be memory-mapped read-only and shared between
+processes; a solve is then a binary search through one row.
+
+Usage:
+   python atlas.py <materials> <thicknesses> [eV_inc]
+
+   materials   : comma separated blade materials in blade order,
+                 e.g. C,C,C,C,C,C,C,C,Si,Si,Si,Si,Si,Si,Si,Si,Si,Si
+   thicknesses : comma separated blade thicknesses [m] in blade order
+   eV_inc      : largest width of the energy bins [eV], default 250
+"""
+
+
+def absorption(h5file, material, eV):
+    """
+    Return the absorption constant of ``material`` at photon
+    energies ``eV`` from the photoabsorption tables.  This is the
+    vectorized (offline) form of ``HXRFilter.get_mu``.
+
+    Parameters:
+       h5file : ``h5py.File``
+       material : ``str``
+       eV : ``NumPy Array``
+    """
+    table = np.asarray(h5file['{}_table'.format(material)])
+    # Adaptive tables are interpolated log-log, uniform ones linearly.
+    if '{}_index'.format(material) in h5file:
+        return np.exp(np.interp(np.log(eV), np.log(table[:,0]),
+                                np.log(table[:,2])))
+    return np.interp(eV, table[:,0], table[:,2])
+
+
+def optical_depths(h5file, materials, thicknesses, eV):
+    """
+    Return the (energy x blade) table of blade optical depths.
+
+    Parameters:
+       h5file : ``h5py.File``
+       materials : ``list`` of ``str``
+       thicknesses : ``NumPy Array``
+       eV : ``NumPy Array``
+    """
+    return np.transpose([absorption(h5file, m, eV)*d
+                         for m, d in zip(materials, thicknesses)])
+
+
+def bin_edges(materials, eV_range, eV_inc):
+    """
+    Return the photon energy bin boundaries of the atlas: a uniform
+    ``eV_inc`` spacing over ``eV_range``, split at the absorption
+    edges of ``materials`` so that no bin contains an edge.
+
+    Parameters:
+       materials : ``list`` of ``str``
+       eV_range : ``tuple``
+       eV_inc : ``float``
+    """
+    n_bins = int(np.ceil((eV_range[1]-eV_range[0])/eV_inc))
+    uniform = eV_range[0] + eV_inc*np.arange(n_bins+1)
+    uniform[-1] = eV_range[1]
+    edges = [edge_energies(m, eV_range) for m in set(materials)]
+    return np.unique(np.concatenate([uniform] + edges))
+
+
+def write_atlas(materials, thicknesses, eV_inc=250.0, eV_range=None,
+                absorption_file='absorption_data.h5',
+                configs_file='configs.h5', atlas_file='atlas.h5'):
+    """
+    Write the solution atlas into an HDF5 file.
+
+    Parameters:
+       materials : ``list`` of ``str``
+       thicknesses : ``array-like``
+       eV_inc : ``float``, largest bin width
+       eV_range : ``tuple``, defaults to the range of the tables
+    """
+    thicknesses = np.asarray(thicknesses, dtype=float)
+    configs = h5py.File(configs_file, 'r')
+    mask = ~np.isnan(np.asarray(configs['configurations']))
+    configs.close()
+    data = h5py.File(absorption_file, 'r')
+    if eV_range is None:
+        tables = [data['{}_table'.format(m)] for m in set(materials)]
+        eV_range = (max(t[0,0] for t in tables),
+                    min(t[-1,0] for t in tables))
+    eV_edges = bin_edges(materials, eV_range, eV_inc)
+    n_bins = len(eV_edges) - 1
+    eV_bins = (eV_edges[:-1] + eV_edges[1:])/2
+    tau = optical_depths(data, materials, thicknesses, eV_bins)
+    data.close()
+    h5 = h5py.File(atlas_file, 'w')
+    order = h5.create_dataset('order', (n_bins, len(mask)), dtype='u4')
+    for k in range(n_bins):
+        # Ascending transmission is descending total optical depth.
+        order[k] = np.argsort(-(mask @ tau[k]), kind='stable')
+    h5.create_dataset('eV_edges', data=eV_edges)
+    h5.create_dataset('thicknesses', data=thicknesses)
+    h5.create_dataset('materials', data=np.asarray(materials, dtype='S'))
+    h5.close()
+
+
+if __name__ == '__main__':
+    materials = sys.argv[1].split(',')
+    thicknesses = [float(d) for d in sys.argv[2].split(',')]
+    if len(sys.argv) > 3:
+        write_atlas(materials, thicknesses, eV_inc=float(sys.argv[3]))
+    else:
+        write_atlas(materials, thicknesses)
@@ -1,6 +1,8 @@
 from caproto.server import pvproperty, PVGroup
 from caproto import ChannelType
 
+T_MAP_POINTS = 256 # must match HXRSatt.T_map_points
+
 class SystemGroup(PVGroup):
     """
     PV group for attenuator system-spanning information.
@@ -35,6 +37,54 @@ class SystemGroup(PVGroup):
                            lower_alarm_limit=0.0,
                            doc='Desired transmission')
 
+    t_actual_lower = pvproperty(value=0.0,
+                                name='T_ACTUAL_LOWER',
+                                mock_record='ao',
+                                upper_alarm_limit=1.0,
+                                lower_alarm_limit=0.0,
+                                doc='Actual transmission '
+                                +'lower confidence bound')
+
+    t_actual_upper = pvproperty(value=0.0,
+                                name='T_ACTUAL_UPPER',
+                                mock_record='ao',
+                                upper_alarm_limit=1.0,
+                                lower_alarm_limit=0.0,
+                                doc='Actual transmission '
+                                +'upper confidence bound')
+
+    t_high_lower = pvproperty(value=0.0,
+                              name='T_HIGH_LOWER',
+                              mock_record='ao',
+                              upper_alarm_limit=1.0,
+                              lower_alarm_limit=0.0,
+                              doc='Best achievable (high) '
+                              +'lower confidence bound')
+
+    t_high_upper = pvproperty(value=0.0,
+                              name='T_HIGH_UPPER',
+                              mock_record='ao',
+                              upper_alarm_limit=1.0,
+                              lower_alarm_limit=0.0,
+                              doc='Best achievable (high) '
+                              +'upper confidence bound')
+
+    t_low_lower = pvproperty(value=0.0,
+                             name='T_LOW_LOWER',
+                             mock_record='ao',
+                             upper_alarm_limit=1.0,
+                             lower_alarm_limit=0.0,
+                             doc='Best achievable (low) '
+                             +'lower confidence bound')
+
+    t_low_upper = pvproperty(value=0.0,
+                             name='T_LOW_UPPER',
+                             mock_record='ao',
+                             upper_alarm_limit=1.0,
+                             lower_alarm_limit=0.0,
+                             doc='Best achievable (low) '
+                             +'upper confidence bound')
+
     t_3omega = pvproperty(value=0.1,
                           name='T_3OMEGA',
                           mock_record='ao',
@@ -57,6 +107,41 @@ class SystemGroup(PVGroup):
                          doc='The system is running',
                          dtype=ChannelType.ENUM)
 
+    t_map = pvproperty(value=[0.0]*T_MAP_POINTS,
+                       name='T_MAP',
+                       mock_record='waveform',
+                       max_length=T_MAP_POINTS,
+                       dtype=ChannelType.DOUBLE,
+                       doc='Sorted achievable transmissions '
+                       +'at the current photon energy')
+
+    t_map_gap = pvproperty(value=1.0,
+                           name='T_MAP_GAP',
+                           mock_record='ao',
+                           doc='Largest ratio between neighbouring '
+                           +'achievable transmissions')
+
+    t_map_gap_low = pvproperty(value=0.0,
+                               name='T_MAP_GAP_LOW',
+                               mock_record='ao',
+                               upper_alarm_limit=1.0,
+                               lower_alarm_limit=0.0,
+                               doc='Achievable transmission below '
+                               +'the largest gap')
+
+    queue_depth = pvproperty(value=0,
+                             name='QUEUE_DEPTH',
+                             mock_record='longin',
+                             doc='Pending transmission requests',
+                             dtype=ChannelType.LONG)
+
+    preemptions = pvproperty(value=0,
+                             name='PREEMPTIONS',
+                             mock_record='longin',
+                             doc='Moves redirected by a '
+                             +'newer request',
+                             dtype=ChannelType.LONG)
+
     mirror_in = pvproperty(value='False',
                            name='MIRROR_IN',
                            mock_record='bo',
@@ -88,6 +173,39 @@ class SystemGroup(PVGroup):
     async def t_3omega(self, instance, value):
         transmission_value_error(value)
 
+    @t_actual_lower.putter
+    async def t_actual_lower(self, instance, value):
+        transmission_value_error(value)
+
+    @t_actual_upper.putter
+    async def t_actual_upper(self, instance, value):
+        transmission_value_error(value)
+
+    @t_high_lower.putter
+    async def t_high_lower(self, instance, value):
+        transmission_value_error(value)
+
+    @t_high_upper.putter
+    async def t_high_upper(self, instance, value):
+        transmission_value_error(value)
+
+    @t_low_lower.putter
+    async def t_low_lower(self, instance, value):
+        transmission_value_error(value)
+
+    @t_low_upper.putter
+    async def t_low_upper(self, instance, value):
+        transmission_value_error(value)
+
+    @t_map.putter
+    async def t_map(self, instance, value):
+        for T in value:
+            transmission_value_error(T)
+
+    @t_map_gap_low.putter
+    async def t_map_gap_low(self, instance, value):
+        transmission_value_error(value)
+
 
 def transmission_value_error(value):
     if value < 0 or value > 1:
@@ -4,10 +4,6 @@ import sys
 import h5py
 
 
-kind = str(sys.argv[1])
-N = int(sys.argv[2])
-
-
 def in_out_attenuator(N):
     """
     Generate all possible in/out state configurations
@@ -24,11 +20,13 @@ def write_h5(config_table):
        config_table : ``NumPy Array``
     """
     h5 = h5py.File('configs.h5', 'w')
-    configs = h5.create_dataset('configurations', (len(config_table),N,), dtype='f')
+    configs = h5.create_dataset('configurations', config_table.shape, dtype='f')
     configs[:] = config_table[:]
     h5.close()
 
 if __name__ == '__main__':
+    kind = str(sys.argv[1])
+    N = int(sys.argv[2])
     if kind == 'inout':
         config_table = in_out_attenuator(N)
         write_h5(config_table)
@@ -117,14 +117,146 @@ def abs_data(material, eV_range):
     return table
 
 
-def gen_table(data_dicts, eV_range=(1000,25000), res=10, dec=2):
+def edge_energies(element, eV_range, gap=1.0):
+    """
+    Return the photon energies bracketing absorption edges.
+
+    The CXRO tables place a pair of points 0.1 eV apart
+    around every sharp edge, so any raw sample spacing
+    below ``gap`` eV is taken to mark an edge.
+
+    Parameters:
+    ---------------
+    element : ``str``
+       Formula of the element to open e.g. "Si", "si", "C", "Au"
+
+    eV_range : ``tuple``
+       Upper and lower bounds of photon energy range.
+
+    gap : ``float``
+       Largest raw sample spacing [eV] treated as an edge.
+    """
+    eV = nff_to_npy(element)[:,0]
+    pairs = np.flatnonzero(np.diff(eV) < gap)
+    edges = np.concatenate([eV[pairs], eV[pairs+1]])
+    return np.sort(edges[(edges >= eV_range[0]) & (edges <= eV_range[1])])
+
+
+def eV_adaptive(eV, mu, tol=1E-4, edges=()):
+    """
+    Select a non-uniform subset of the dense grid ``eV`` on which
+    log-log interpolation reproduces every dense sample of ``mu``
+    to within a relative error of ``tol``.  Segments are bisected
+    at their worst sample until the bound holds, which keeps the
+    grid dense around absorption edges and sparse elsewhere.
+
+    Returns a boolean mask of the retained samples.
+
+    Parameters:
+    ---------------
+    eV : ``NumPy Array``
+       Dense, increasing photon energy grid.
+
+    mu : ``NumPy Array``
+       Absorption constant sampled on ``eV``.
+
+    tol : ``float``
+       Maximum relative interpolation error of ``mu``.  The
+       transmission error of a blade of thickness d is then
+       bounded by roughly ``tol*mu*d``.
+
+    edges : ``array-like``
+       Photon energies which must be kept as grid points.
+    """
+    log_eV = np.log(eV)
+    log_mu = np.log(mu)
+    keep = np.zeros(len(eV), dtype=bool)
+    keep[[0, -1]] = True
+    i_edges = np.searchsorted(eV, edges)
+    keep[np.clip(np.concatenate([i_edges-1, i_edges]), 0, len(eV)-1)] = True
+    knots = np.flatnonzero(keep)
+    segments = list(zip(knots[:-1], knots[1:]))
+    while segments:
+        a, b = segments.pop()
+        if b - a < 2:
+            continue
+        slope = (log_mu[b]-log_mu[a])/(log_eV[b]-log_eV[a])
+        interp = log_mu[a] + slope*(log_eV[a+1:b]-log_eV[a])
+        err = np.abs(np.expm1(interp - log_mu[a+1:b]))
+        k = np.argmax(err)
+        if err[k] > tol:
+            m = a + 1 + k
+            keep[m] = True
+            segments.extend([(a, m), (m, b)])
+    return keep
+
+
+def coarse_index(eV_grid, eV_min, eV_inc):
+    """
+    Uniform index into a variable photon energy grid.
+
+    Entry ``k`` is the grid segment containing
+    ``eV_min + k*eV_inc``, so a lookup only has to
+    search the few grid points within one coarse bin.
+
+    Parameters:
+    ---------------
+    eV_grid : ``NumPy Array``
+       Increasing, non-uniform photon energy grid.
+
+    eV_min : ``float``
+       Photon energy of the first coarse bin.
+
+    eV_inc : ``float``
+       Width of the coarse bins [eV].
+    """
+    n_bins = int(np.ceil((eV_grid[-1]-eV_min)/eV_inc)) + 1
+    starts = eV_min + eV_inc*np.arange(n_bins)
+    index = np.searchsorted(eV_grid, starts, side='right') - 1
+    return np.clip(index, 0, len(eV_grid)-2).astype(np.int32)
+
+
+def abs_data_adaptive(material, eV_range, tol=1E-4, eV_inc=10.0):
+    """
+    Adaptive data table for photoabsorption calculations
+    and its coarse lookup index.
+    """
+    dense = abs_data(material, eV_range)
+    edges = edge_energies(material.get('formula'), eV_range)
+    keep = eV_adaptive(dense[:,0], dense[:,2], tol=tol, edges=edges)
+    table = dense[keep]
+    index = coarse_index(table[:,0], table[0,0], eV_inc)
+    return table, index
+
+
+def gen_table(data_dicts, eV_range=(1000,25000), res=10, dec=2,
+              adaptive=True, tol=1E-4, eV_inc=10.0):
+    """
+    Write the photoabsorption tables of every material in
+    ``data_dicts`` to ``absorption_data.h5``.
+
+    With ``adaptive`` the tables are stored on a non-uniform
+    grid (see ``eV_adaptive``) together with a ``<formula>_index``
+    dataset holding the coarse lookup index, otherwise on the
+    uniform 1/``res`` eV grid.
+    """
     h5 = h5py.File('./absorption_data.h5','w')
     for data in data_dicts:
         element = data.get('formula')
-        table = abs_data(data, eV_range)
+        if adaptive:
+            table, index = abs_data_adaptive(data, eV_range,
+                                             tol=tol, eV_inc=eV_inc)
+            data_index = h5.create_dataset('{}_index'.format(element),
+                                           data=index)
+            data_index.attrs['eV_inc'] = eV_inc
+            data_index.attrs['tol'] = tol
+        else:
+            table = abs_data(data, eV_range)
+        # Adaptive tables are small, and float32 storage alone would
+        # exceed the interpolation tolerance they were built for.
         data_table = h5.create_dataset('{}_table'.format(element),
                                         table.shape,
-                                        dtype='f')
+                                        dtype='f8' if adaptive else 'f')
         data_consts = h5.create_dataset('{}_constants'.format(element),
                                     (3,),
                                     dtype=float)
@@ -0,0 +1,206 @@
+import numpy as np
+import re
+import sys
+import h5py
+from concurrent.futures import ProcessPoolExecutor
+
+from atlas import absorption
+from configurations import in_out_attenuator
+
+"""
+Blade thickness set designer for new attenuator builds.
+
+Random candidate thickness sets (and material assignments) are scored
+by how evenly their in/out configurations cover transmission space
+over a photon energy range, using the photoabsorption tables written
+by ``data_conditioner.py``.  Every candidate is evaluated in one
+vectorized pass over all configurations and energies; candidates are
+spread over a process pool.  Existing sets, such as the one in
+``AT2L0_sys_settings.sh``, can be scored alongside for reference.
+
+Usage:
+   python designer.py <materials> <N> <eV_min> <eV_max> [n_candidates]
+                      [settings]
+
+   materials    : comma separated material choices, e.g. C,Si
+   N            : number of blades
+   eV_min       : lower bound of the photon energy range [eV]
+   eV_max       : upper bound of the photon energy range [eV]
+   n_candidates : number of random designs to score, default 1000
+   settings     : caput script of an existing set to score for reference
+"""
+
+# Set in every worker process by ``_init_worker``.
+_worker = {}
+
+
+def _init_worker(mu, mask, T_min):
+    """
+    Share the absorption constants, configuration mask and
+    transmission floor with a worker process.
+    """
+    _worker.update(mu=mu, mask=mask, T_min=T_min)
+
+
+def score(materials, thicknesses, mu, mask, T_min=1E-6):
+    """
+    Score a thickness set over all energies at once.
+
+    Returns the worst-case gap between neighbouring achievable
+    transmissions above ``T_min`` and the smallest dynamic range,
+    both in decades, over the energies sampled in ``mu``.
+
+    The gap includes the span from the lowest achievable
+    transmission down to ``T_min``, so a set whose dynamic range
+    falls short of ``T_min`` at any energy scores a gap of at least
+    that shortfall.  The gap alone therefore ranks designs on both
+    coverage and range down to ``T_min``; the dynamic range is
+    returned for information.
+
+    Parameters:
+       materials : ``list`` of ``str``
+       thicknesses : ``NumPy Array``
+       mu : ``dict`` of absorption constants per material
+       mask : ``NumPy Array`` of inserted blades per configuration
+       T_min : ``float``
+    """
+    tau = np.array([mu[m]*d for m, d in zip(materials, thicknesses)],
+                   dtype=np.float32)
+    depth = mask @ tau # (configuration x energy) optical depths
+    depth.sort(axis=0)
+    tau_max = -np.log(T_min)
+    clipped = np.minimum(depth, tau_max)
+    gaps = np.diff(clipped, axis=0).max(axis=0)
+    gaps = np.maximum(gaps, tau_max - clipped[-1]) # floor not reached
+    return float(gaps.max()/np.log(10)), float(depth[-1].min()/np.log(10))
+
+
+def _score_candidate(candidate):
+    """
+    Score one ``(materials, thicknesses)`` candidate in a worker.
+    """
+    materials, thicknesses = candidate
+    return score(materials, thicknesses, _worker['mu'],
+                 _worker['mask'], _worker['T_min'])
+
+
+def read_settings(path):
+    """
+    Read the blade materials and thicknesses [m] set by a caput
+    script such as ``AT2L0_sys_settings.sh``, in blade order.
+
+    Parameters:
+       path : ``str``
+    """
+    pattern = re.compile(r'caput\s+\S+:FILTER:(\d+):(MATERIAL|THICKNESS)'
+                         r'\s+"?([^"\s]+)"?')
+    settings = {}
+    for line in open(path, 'r'):
+        match = pattern.match(line.strip())
+        if match:
+            index, field, value = match.groups()
+            settings.setdefault(int(index), {})[field] = value
+    blades = [settings[i] for i in sorted(settings)]
+    return ([b['MATERIAL'] for b in blades],
+            np.array([float(b['THICKNESS']) for b in blades]))
+
+
+def candidates(material_choices, N, n_candidates, d_range=(1E-6, 1E-2),
+               seed=None):
+    """
+    Generate random designs of ``N`` blades.  Thicknesses [m] are
+    drawn log-uniformly from ``d_range`` independently of the
+    material; blades are then grouped by material, thickest first.
+    """
+    rng = np.random.default_rng(seed)
+    designs = list()
+    for _ in range(n_candidates):
+        materials = rng.choice(material_choices, N)
+        d = np.exp(rng.uniform(*np.log(d_range), N))
+        order = np.lexsort((-d, materials))
+        designs.append((materials[order].tolist(), d[order]))
+    return designs
+
+
+def _tables(materials, N, eV_range, n_eV, absorption_file):
+    """
+    Return the absorption constants of ``materials`` at ``n_eV``
+    log-spaced energies and the configuration mask of ``N`` blades.
+    """
+    eV = np.geomspace(eV_range[0], eV_range[1], n_eV)
+    h5 = h5py.File(absorption_file, 'r')
+    mu = {m: absorption(h5, m, eV) for m in set(materials)}
+    h5.close()
+    mask = (~np.isnan(in_out_attenuator(N))).astype(np.float32)
+    return mu, mask
+
+
+def score_design(materials, thicknesses, eV_range, n_eV=32, T_min=1E-6,
+                 absorption_file='absorption_data.h5'):
+    """
+    Score one given thickness set, e.g. from ``read_settings``.
+    Returns ``(worst_gap, min_range)`` in decades, see ``score``.
+    """
+    mu, mask = _tables(materials, len(materials), eV_range, n_eV,
+                       absorption_file)
+    return score(materials, thicknesses, mu, mask, T_min)
+
+
+def design(material_choices, N, eV_range, n_candidates=1000, n_eV=32,
+           T_min=1E-6, max_workers=None, seed=None, references=(),
+           absorption_file='absorption_data.h5'):
+    """
+    Search random thickness sets and return all candidates as
+    ``(worst_gap, min_range, materials, thicknesses)`` sorted by
+    increasing worst-case gap.  Gaps and ranges are in decades.
+    The gap already accounts for range down to ``T_min`` (see
+    ``score``); the range only breaks exact ties.
+
+    Parameters:
+       material_choices : ``list`` of ``str``
+       N : ``int``
+       eV_range : ``tuple``
+       n_candidates : ``int``
+       n_eV : ``int``, energies sampled (log spaced) over ``eV_range``
+       T_min : ``float``, lowest transmission of interest
+       max_workers : ``int``, size of the process pool
+       references : ``list`` of ``(materials, thicknesses)`` designs
+                    scored and ranked with the candidates
+    """
+    for materials, thicknesses in references:
+        if len(materials) != N or len(thicknesses) != N:
+            raise ValueError('Reference designs must have '
+                             +'{} blades'.format(N))
+    materials = list(material_choices)
+    for m, _ in references:
+        materials += m
+    mu, mask = _tables(materials, N, eV_range, n_eV, absorption_file)
+    designs = list(references) + candidates(material_choices, N,
+                                            n_candidates, seed=seed)
+    with ProcessPoolExecutor(max_workers=max_workers,
+                             initializer=_init_worker,
+                             initargs=(mu, mask, T_min)) as pool:
+        scores = list(pool.map(_score_candidate, designs,
+                               chunksize=max(1, len(designs)//64)))
+    results = [(gap, dyn, m, d) for (gap, dyn), (m, d)
+               in zip(scores, designs)]
+    return sorted(results, key=lambda r: (r[0], -r[1]))
+
+
+if __name__ == '__main__':
+    material_choices = sys.argv[1].split(',')
+    N = int(sys.argv[2])
+    eV_range = (float(sys.argv[3]), float(sys.argv[4]))
+    n_candidates = int(sys.argv[5]) if len(sys.argv) > 5 else 1000
+    references = [read_settings(sys.argv[6])] if len(sys.argv) > 6 else []
+    results = design(material_choices, N, eV_range, n_candidates,
+                     references=references)
+    for materials, thicknesses in references:
+        rank, (gap, dyn) = next((i, r[:2]) for i, r in enumerate(results)
+                                if r[2] is materials)
+        print("reference (rank {} of {}): gap {:.3f} dec, "
+              "range {:.1f} dec".format(rank+1, len(results), gap, dyn))
+    for gap, dyn, materials, thicknesses in results[:10]:
+        print("gap {:.3f} dec, range {:.1f} dec: {}".format(
+            gap, dyn, ', '.join('{} {:.1f}um'.format(m, d*1E6)
+                                for m, d in zip(materials, thicknesses))))
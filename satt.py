@@ -1,4 +1,8 @@
 import logging
+import os
+import queue
+import threading
+import time
 from ophyd.device import Device, Component as Cpt, FormattedComponent as FCpt
 from ophyd import EpicsSignal, EpicsSignalRO
 from ophyd.status import wait as status_wait
@@ -9,6 +13,100 @@ from pcdsdevices.inout import TwinCATInOutPositioner
 logger = logging.getLogger(__name__)
 
 
+def plan_moves(tau, depth, to_insert, to_remove, T_floor=None):
+    """
+    Group blade moves into as few concurrent batches as possible.
+
+    While a batch is moving any subset of its moves may have
+    finished, so the transmission stays at or below
+    max(T_start, T_target) only if it does with all of the
+    batch's removals done and none of its insertions; likewise it
+    stays above the floor only if it does with all insertions done
+    and no removals.  The floor is the lowest of ``T_floor``, T_start
+    and T_target, as the endpoints themselves must be allowed.
+    Batches are filled first-fit by decreasing optical depth under
+    those two limits.  Without a floor this gives a single batch
+    whenever that is safe and never more than two.  If no move fits,
+    the thinnest remaining blade is inserted on its own, breaking
+    the floor as little as possible, and the rest is replanned.
+
+    Returns the list of (insert, remove) batches and whether the
+    floor could be kept.
+
+    Parameters:
+       tau : ``NumPy Array``, optical depth of blade ``i`` at ``tau[i-1]``
+       depth : ``float``, optical depth of the starting configuration
+       to_insert : ``list`` of blade indices
+       to_remove : ``list`` of blade indices
+       T_floor : ``float``, optional lowest transmission
+    """
+    depth_target = (depth + sum(tau[f-1] for f in to_insert)
+                    - sum(tau[f-1] for f in to_remove))
+    depth_cap = min(depth, depth_target)
+    depth_floor = max(-np.log(T_floor) if T_floor else np.inf,
+                      depth, depth_target)
+    eps = 1E-9*max(depth, 1) # rounding of the depth sums
+    to_insert = sorted(to_insert, key=lambda f: -tau[f-1])
+    to_remove = sorted(to_remove, key=lambda f: -tau[f-1])
+    batches = list()
+    floor_kept = True
+    while to_insert or to_remove:
+        batch_in, batch_out = list(), list()
+        budget = depth_floor - depth + eps
+        for f in to_insert:
+            if tau[f-1] <= budget:
+                batch_in.append(f)
+                budget -= tau[f-1]
+        budget = depth - depth_cap + eps
+        for f in to_remove:
+            if tau[f-1] <= budget:
+                batch_out.append(f)
+                budget -= tau[f-1]
+        if not batch_in and not batch_out:
+            logger.warning("Transmission floor %s cannot be kept, "
+                           "inserting the thinnest filter alone", T_floor)
+            floor_kept = False
+            batch_in = to_insert[-1:]
+            batch_out = list() if batch_in else list(to_remove)
+        to_insert = [f for f in to_insert if f not in batch_in]
+        to_remove = [f for f in to_remove if f not in batch_out]
+        depth += (sum(tau[f-1] for f in batch_in)
+                  - sum(tau[f-1] for f in batch_out))
+        batches.append((batch_in, batch_out))
+    return batches, floor_kept
+
+
+def check_plan(tau, depth, batches, T_floor=None):
+    """
+    Check a move plan from ``plan_moves``: True if for every subset
+    of each batch's moves that may have finished the transmission
+    stays at or below max(T_start, T_target) and, if ``T_floor`` is
+    given, at or above min(T_floor, T_start, T_target).  Only the
+    extremes of each batch are checked: all removals done and no
+    insertions, and all insertions done and no removals.
+
+    Parameters:
+       tau : ``NumPy Array``, optical depth of blade ``i`` at ``tau[i-1]``
+       depth : ``float``, optical depth of the starting configuration
+       batches : ``list`` of (insert, remove) lists of blade indices
+       T_floor : ``float``, optional lowest transmission
+    """
+    moves = [np.array([tau[f-1] for f in batch_in]
+                      + [-tau[f-1] for f in batch_out], dtype=float)
+             for batch_in, batch_out in batches]
+    depth_target = depth + sum(m.sum() for m in moves)
+    depth_cap = min(depth, depth_target)
+    depth_floor = max(-np.log(T_floor) if T_floor else np.inf,
+                      depth, depth_target)
+    eps = 1E-9*max(depth, 1)
+    for m in moves:
+        if (depth + m[m < 0].sum() < depth_cap - eps
+                or depth + m[m > 0].sum() > depth_floor + eps):
+            return False
+        depth += m.sum()
+    return True
+
+
 class HXRFilter(Device):
     """
     A single attenuation blade.
@@ -34,6 +132,15 @@ class HXRFilter(Device):
                      '{prefix}:FILTER:{self.index_str}:IS_STUCK',
                      kind='normal')
     tab_whitelist = ['inserted', 'removed', 'insert', 'remove', 'transmission']
+
+    # Relative 1-sigma uncertainties used for transmission bounds.
+    thickness_err = 0.02 # blade thickness tolerance
+    density_err = 0.01 # material density
+    f2_err = 0.03 # CXRO scattering factor f_2
+
+    # Run whenever the thickness or material of the blade changes
+    # and its physics data has been reloaded.
+    SUB_DATA_CHANGED = 'data_changed'
     
     def __init__(self,
                  prefix,
@@ -44,23 +151,74 @@ class HXRFilter(Device):
         self.index_str = f'{index}'.zfill(2)
         self.index = index
         super().__init__(prefix, name=name, **kwargs)
-        self.constants, self._data, self._eV_min, self._eV_inc, self._eV_max = self.load_data(h5file)
+        self._h5file = h5file
+        self._set_data(self.material.get())
+        self.d = self.thickness.get()
+        self.thickness.subscribe(self._thickness_callback, run=False)
+        self.material.subscribe(self._material_callback, run=False)
+
+    def _set_data(self, material):
+        """
+        Load the physics tables and constants for ``material``.
+        """
+        self.constants, self._data, self._eV_min, self._eV_inc, self._eV_max = self.load_data(self._h5file, material)
+        self._material = material
+        self._index = self.load_index(self._h5file, material)
+        if self._index is not None:
+            self._eV_inc = self._h5file['{}_index'.format(material)].attrs['eV_inc']
         self.Z = self.atomic_number = int(self.constants[0]) # atomic number
         self.A = self.atomic_weight = self.constants[1] # atomic weight [g]
         self.p = self.density = self.constants[2] # density [g/cm^3]
-        self.d = self.thickness.get()
 
-    def load_data(self, h5file):
+    def load_data(self, h5file, material=None):
         """
         Loads HDF5 physics data into tables.
         """
-        table = np.asarray(h5file['{}_table'.format(self.material.get())])
-        constants = np.asarray(h5file['{}_constants'.format(self.material.get())])
+        if material is None:
+            material = self.material.get()
+        table = np.asarray(h5file['{}_table'.format(material)])
+        constants = np.asarray(h5file['{}_constants'.format(material)])
         eV_min = table[0,0]
         eV_max = table[-1,0]
         eV_inc = (table[-1,0] - table[0,0])/len(table[:,0])
         return constants, table, eV_min, eV_inc, eV_max
 
+    def load_index(self, h5file, material=None):
+        """
+        Loads the coarse lookup index of an adaptive (non-uniform)
+        energy table, or returns ``None`` for a uniform table.
+        """
+        if material is None:
+            material = self.material.get()
+        name = '{}_index'.format(material)
+        if name not in h5file:
+            return None
+        return np.asarray(h5file[name])
+
+    def _grid_index(self, eV):
+        """
+        Return the index of the adaptive table segment
+        containing ``eV`` using the coarse lookup index.
+        """
+        k = min(int((eV - self._eV_min)/self._eV_inc), len(self._index)-1)
+        j = self._index[k]
+        last = self._data.shape[0] - 2
+        while j < last and self._data[j+1,0] <= eV:
+            j += 1
+        return j
+
+    def _interp_mu(self, eV):
+        """
+        Return ``eV`` (clipped to the table range) and its absorption
+        constant, log-log interpolated from an adaptive table.
+        """
+        eV = min(max(eV, self._eV_min), self._eV_max)
+        j = self._grid_index(eV)
+        E0, E1 = self._data[j,0], self._data[j+1,0]
+        mu0, mu1 = self._data[j,2], self._data[j+1,2]
+        mu = mu0*(mu1/mu0)**(np.log(eV/E0)/np.log(E1/E0))
+        return eV, mu
+
     def _closest_eV(self, eV):
         """
         Return the closest tabulated photon energy to ``eV``
@@ -76,13 +234,56 @@ class HXRFilter(Device):
         closest_eV = self._data[i,0]
         return closest_eV, i
 
+    def _thickness_callback(self, value=None, **kwargs):
+        """
+        To be run every time the ``thickness`` signal changes.
+        """
+        if value is None or value == self.d:
+            return
+        logger.debug("Filter %s thickness changed to %s", self.index, value)
+        self.d = value
+        self._run_subs(sub_type=self.SUB_DATA_CHANGED, index=self.index)
+
+    def _material_callback(self, value=None, **kwargs):
+        """
+        To be run every time the ``material`` signal changes.
+        Only this blade's tables are reloaded.
+        """
+        if value is None:
+            return
+        logger.debug("Filter %s material changed to %s", self.index, value)
+        try:
+            self._set_data(value)
+        except KeyError:
+            logger.error("No absorption data for material %s, "
+                         "filter %s keeps its previous data", value, self.index)
+            return
+        self._run_subs(sub_type=self.SUB_DATA_CHANGED, index=self.index)
+
+    def get_mu(self, eV):
+        """
+        Return closest photon energy to ``eV`` and its
+        absorption constant.
+        """
+        if self._index is not None:
+            return self._interp_mu(eV)
+        close_eV, i = self._closest_eV(eV)
+        return close_eV, self._data[i,2]
+
     def get_vals(self, eV):
         """
         Return closest photon energy to ``eV`` and its transmission.
         """
-        close_eV, i = self._closest_eV(eV)
-        T = np.exp(-self._data[i,2]*self.d)
+        close_eV, mu = self.get_mu(eV)
+        T = np.exp(-mu*self.d)
         return close_eV, T
+
+    def optical_depth(self, eV):
+        """
+        Return the optical depth (-ln of the transmission)
+        at photon energy closest ``eV``.
+        """
+        return self.get_mu(eV)[1]*self.d
     
     def transmission(self, eV):
         """
@@ -122,6 +323,17 @@ class HXRSatt(Device):
     """
     cbid = None
     retries = 3
+    cache_size = 8 # number of photon energies kept in the solver caches
+    eV_quantum = 1.0 # map photon energies are rounded to this [eV]
+    T_map_points = 256 # length of the achievable transmission waveform
+    T_map_min = 1E-10 # lowest transmission included in the map
+    T_map_period = 1.0 # shortest interval between map updates [s]
+    atlas_file = None # precomputed solution atlas, see atlas.py
+    atlas_window = 64 # atlas entries re-evaluated around a search result
+    uncertainty = False # publish Monte Carlo transmission bounds
+    mc_samples = 4096 # perturbations sampled per bound calculation
+    confidence = 0.95 # confidence level of the transmission bounds
+    T_floor = None # optional lowest transmission allowed during a move
     tab_component_names = True
     tab_whitelist = []
     
@@ -139,6 +351,18 @@ class HXRSatt(Device):
                     kind='hinted') # closest achievable high
     T_low = FCpt(EpicsSignal, '{prefix}:SYS:T_LOW',
                     kind='hinted') # closest achievable low
+    T_actual_lower = FCpt(EpicsSignal, '{prefix}:SYS:T_ACTUAL_LOWER',
+                    kind='normal') # confidence bounds of T_actual
+    T_actual_upper = FCpt(EpicsSignal, '{prefix}:SYS:T_ACTUAL_UPPER',
+                    kind='normal')
+    T_high_lower = FCpt(EpicsSignal, '{prefix}:SYS:T_HIGH_LOWER',
+                    kind='normal') # confidence bounds of T_high
+    T_high_upper = FCpt(EpicsSignal, '{prefix}:SYS:T_HIGH_UPPER',
+                    kind='normal')
+    T_low_lower = FCpt(EpicsSignal, '{prefix}:SYS:T_LOW_LOWER',
+                    kind='normal') # confidence bounds of T_low
+    T_low_upper = FCpt(EpicsSignal, '{prefix}:SYS:T_LOW_UPPER',
+                    kind='normal')
     T_des = FCpt(EpicsSignal, '{prefix}:SYS:T_DESIRED',
                     kind='hinted')
     T_3omega = FCpt(EpicsSignal, '{prefix}:SYS:T_3OMEGA',
@@ -147,6 +371,16 @@ class HXRSatt(Device):
                     kind='hinted')
     running = FCpt(EpicsSignal, '{prefix}:SYS:MOVING',
                     kind='hinted')
+    queue_depth = FCpt(EpicsSignal, '{prefix}:SYS:QUEUE_DEPTH',
+                    kind='normal') # pending transmission requests
+    preemptions = FCpt(EpicsSignal, '{prefix}:SYS:PREEMPTIONS',
+                    kind='normal') # moves redirected by a newer request
+    T_map = FCpt(EpicsSignal, '{prefix}:SYS:T_MAP',
+                    kind='normal') # achievable transmissions
+    T_map_gap = FCpt(EpicsSignal, '{prefix}:SYS:T_MAP_GAP',
+                    kind='normal') # worst ratio between neighbours
+    T_map_gap_low = FCpt(EpicsSignal, '{prefix}:SYS:T_MAP_GAP_LOW',
+                    kind='normal') # transmission below the worst gap
 #    mirror_in = FCpt(EpicsSignalRO, '{prefix}:SYS:T_VALID',
 #                    kind='hinted')
 #    transmission_valid = FCpt(EpicsSignalRO, '{prefix}:SYS:T_VALID',
@@ -164,9 +398,34 @@ class HXRSatt(Device):
         and photon energy.
         """
         self.N_filters = len(self.filters)
+        self._rng = np.random.default_rng()
+        self._T_cache = {}
+        self._T_table_cache = {}
+        # Guards both caches.  Cached arrays are never modified once
+        # stored, so anything handed out stays a consistent snapshot.
+        self._cache_lock = threading.RLock()
         self.config_arr = self._curr_config_arr()
         self.config_table = self._load_configs()
+        self._load_atlas()
         self.curr_transmission()
+        self._T_map_eV = None
+        self._T_map_pending = threading.Event()
+        self._T_map_thread = threading.Thread(target=self._T_map_loop,
+                                              name=f'{self.name}_T_map',
+                                              daemon=True)
+        self._T_map_thread.start()
+        for f in self.filters.values():
+            f.subscribe(self._filter_data_callback,
+                        event_type=f.SUB_DATA_CHANGED, run=False)
+            f.stuck.subscribe(self._stuck_callback, run=False)
+        self._requests = queue.Queue()
+        self._moving = threading.Event()
+        self._preempt = threading.Event()
+        self._n_preempted = 0
+        self._control_thread = threading.Thread(target=self._control_loop,
+                                                name=f'{self.name}_control',
+                                                daemon=True)
+        self._control_thread.start()
         self.eV.subscribe(self._eV_callback)
         self.T_des.subscribe(self._T_des_callback)
         self.run.subscribe(self._run_callback)
@@ -216,8 +475,88 @@ class HXRSatt(Device):
         Load the HDF5 table of possible configurations.
         """
         self.config_table = self.configs['configurations']
+        # Boolean (configuration x blade) mask of inserted blades,
+        # used to recompute only the rows touched by a blade change.
+        self._config_mask = ~np.isnan(np.asarray(self.config_table))
         return self.config_table
-        
+
+    def _load_atlas(self):
+        """
+        Memory-map the precomputed solution atlas read-only, if
+        ``atlas_file`` is set and exists.
+        """
+        self._atlas = None
+        if not self.atlas_file or not os.path.exists(self.atlas_file):
+            return self._atlas
+        with h5py.File(self.atlas_file, 'r') as h5:
+            order = h5['order']
+            offset = order.id.get_offset()
+            if (offset is None or 'eV_edges' not in h5
+                or order.shape[1] != len(self._config_mask)):
+                logger.warning("Atlas %s cannot be used, falling back "
+                               "to the live solver", self.atlas_file)
+                return self._atlas
+            self._atlas_eV_edges = np.asarray(h5['eV_edges'])
+            self._atlas_d = np.asarray(h5['thicknesses'])
+            self._atlas_materials = [m.decode() for m in h5['materials']]
+            self._atlas = np.memmap(self.atlas_file, dtype=order.dtype,
+                                    mode='r', offset=offset,
+                                    shape=order.shape)
+        return self._atlas
+
+    def _atlas_valid(self):
+        """
+        True if the atlas was built for the current filter
+        materials and thicknesses and no filter is stuck.
+        """
+        if self._atlas is None:
+            return False
+        for i in range(self.N_filters):
+            blade = self.blade(i+1)
+            if (blade.is_stuck()
+                or blade._material != self._atlas_materials[i]
+                or not np.isclose(blade.d, self._atlas_d[i])):
+                return False
+        return True
+
+    def _atlas_search(self, eV, T_des):
+        """
+        Return the configuration indices with the closest lower
+        and higher transmission to ``T_des`` at photon energy ``eV``
+        using the atlas.  The atlas row for the energy bin is binary
+        searched, then the entries around the result are re-evaluated
+        at ``eV`` itself to absorb ordering changes within the bin.
+
+        Returns ``None`` if the re-evaluated entries do not bracket
+        ``T_des``, i.e. the row is not ordered closely enough at
+        ``eV`` to be trusted.
+        """
+        k = np.searchsorted(self._atlas_eV_edges, eV, side='right') - 1
+        order = self._atlas[min(max(k, 0), len(self._atlas)-1)]
+        tau = np.array([self.blade(i+1).optical_depth(eV)
+                        for i in range(self.N_filters)])
+        tau_des = -np.log(T_des)
+        lo, hi = 0, len(order)
+        while lo < hi:
+            mid = (lo + hi)//2
+            if self._config_mask[order[mid]] @ tau > tau_des:
+                lo = mid + 1
+            else:
+                hi = mid
+        window = np.asarray(order[max(lo-self.atlas_window, 0):
+                                  lo+self.atlas_window])
+        tau_win = self._config_mask[window] @ tau
+        below = tau_win >= tau_des
+        above = tau_win <= tau_des
+        if ((lo > 0 and not below.any())
+            or (lo < len(order) and not above.any())):
+            return None
+        i_low = window[np.argmin(np.where(below, tau_win, np.inf))] \
+            if below.any() else window[np.argmax(tau_win)]
+        i_high = window[np.argmax(np.where(above, tau_win, -np.inf))] \
+            if above.any() else window[np.argmin(tau_win)]
+        return i_low, i_high
+
     # Need a callback on every blade to grab its state and update config...
     def _curr_config_arr(self):
         """
@@ -233,30 +572,231 @@ class HXRSatt(Device):
         self.config_arr = config
         return config
 
+    def _cache_put(self, cache, key, value):
+        """
+        Store ``value`` in ``cache``, dropping the oldest
+        entry once ``cache_size`` entries are held.
+        """
+        if key not in cache and len(cache) >= self.cache_size:
+            cache.pop(next(iter(cache)))
+        cache[key] = value
+        return value
+
+    def _quantize_eV(self, eV):
+        """
+        Round ``eV`` to ``eV_quantum`` so that a drifting photon
+        energy keeps hitting the caches when refreshing the map.
+        Published transmissions and solves use the exact energy.
+        """
+        return round(eV/self.eV_quantum)*self.eV_quantum
+
+    def _blade_transmissions(self, eV):
+        """
+        Returns the cached transmission of every filter at
+        photon energy ``eV``, regardless of stuck state.
+        """
+        with self._cache_lock:
+            T_raw = self._T_cache.get(eV)
+            if T_raw is None:
+                T_raw = np.array([self.blade(i+1).transmission(eV)
+                                  for i in range(self.N_filters)])
+                self._cache_put(self._T_cache, eV, T_raw)
+        return T_raw
+
     def _all_transmissions(self, eV):
         """
         Calculates and returns transmission at
         photon energy ``eV`` for all non-stuck filters.
         """
-        T_arr = np.ones(self.N_filters)
+        T_arr = np.array(self._blade_transmissions(eV))
         for i in range(self.N_filters):
             if self.blade(i+1).is_stuck():
-                T_arr = np.nan
-            else:
-                T_arr[i] = self.blade(i+1).transmission(eV)
+                T_arr[i] = np.nan
         return T_arr
 
-    def curr_transmission(self, eV=None):
+    def _config_transmissions(self, eV):
+        """
+        Returns the cached solver entry at photon energy ``eV``:
+        the filter transmissions used, the transmission of every
+        configuration and its sort order (computed on demand).
+        The entry is a snapshot and must not be modified.
+        """
+        with self._cache_lock:
+            T_set = self._all_transmissions(eV)
+            key = (eV, tuple(np.isnan(T_set)))
+            entry = self._T_table_cache.get(key)
+            if entry is None:
+                T_table = np.nanprod(
+                    np.where(self._config_mask, T_set, np.nan), axis=1)
+                entry = {'T_set': T_set, 'T_table': T_table, 'order': None}
+            if entry['order'] is None:
+                entry = dict(entry, order=np.argsort(entry['T_table'],
+                                                     kind='stable'))
+                self._cache_put(self._T_table_cache, key, entry)
+        return entry
+
+    def _filter_data_callback(self, index=None, **kwargs):
+        """
+        To be run every time a filter's thickness or material changes.
+        Only the cached values depending on filter ``index`` are
+        recomputed, the rest of the solver state is kept.
+        """
+        i = index - 1
+        blade = self.blade(index)
+        rows = self._config_mask[:, i]
+        with self._cache_lock:
+            for eV, T_raw in list(self._T_cache.items()):
+                T_raw = np.array(T_raw)
+                T_raw[i] = blade.transmission(eV)
+                self._T_cache[eV] = T_raw
+            for key, entry in list(self._T_table_cache.items()):
+                eV, stuck = key
+                if stuck[i]:
+                    continue # Stuck filters do not contribute.
+                T_set = np.array(entry['T_set'])
+                T_set[i] = blade.transmission(eV)
+                T_table = np.array(entry['T_table'])
+                T_table[rows] = np.nanprod(
+                    np.where(self._config_mask[rows], T_set, np.nan),
+                    axis=1)
+                self._T_table_cache[key] = {'T_set': T_set,
+                                            'T_table': T_table,
+                                            'order': None}
+        self.curr_transmission()
+        self._update_T_des_limits()
+        self._request_T_map()
+
+    def _stuck_callback(self, value=None, **kwargs):
+        """
+        To be run every time a filter's ``stuck`` signal changes.
+        """
+        self._request_T_map()
+
+    def achievable_transmissions(self, eV=None, points=None):
+        """
+        Return the sorted set of transmissions reachable at photon
+        energy ``eV`` with the available (non-stuck) filters, along
+        with the worst ratio between neighbouring values and the
+        transmission just below that gap.
+
+        If ``points`` is given the set is downsampled to at most
+        that many values spread evenly in log-transmission.  The gap
+        is always computed on the full set.
+        """
+        if not eV:
+            eV = self.eV.get()
+        entry = self._config_transmissions(eV)
+        T_sorted = entry['T_table'][entry['order']]
+        T_vals = np.unique(T_sorted[T_sorted >= self.T_map_min])
+        if len(T_vals) > 1:
+            ratios = T_vals[1:]/T_vals[:-1]
+            i = np.argmax(ratios)
+            gap, gap_low = ratios[i], T_vals[i]
+        else:
+            gap, gap_low = 1.0, T_vals[0] if len(T_vals) else 0.0
+        if points and len(T_vals) > points:
+            log_T = np.log(T_vals)
+            targets = np.linspace(log_T[0], log_T[-1], points)
+            i = np.clip(np.searchsorted(log_T, targets), 1, len(T_vals)-1)
+            nearer_low = targets - log_T[i-1] < log_T[i] - targets
+            T_vals = np.unique(T_vals[i - nearer_low])
+        return T_vals, gap, gap_low
+
+    def _update_T_map(self, eV=None):
+        """
+        Publish the achievable transmission map at photon energy ``eV``,
+        rounded to ``eV_quantum``.
+        """
+        if not eV:
+            eV = self.eV.get()
+        T_vals, gap, gap_low = self.achievable_transmissions(
+            self._quantize_eV(eV), points=self.T_map_points)
+        self.T_map.put(T_vals)
+        self.T_map_gap.put(gap)
+        self.T_map_gap_low.put(gap_low)
+
+    def _request_T_map(self, eV=None):
+        """
+        Ask the map thread to republish the achievable transmission
+        map.  Requests made while it is busy are coalesced and only
+        the latest photon energy is used.
+        """
+        self._T_map_eV = eV
+        self._T_map_pending.set()
+
+    def _T_map_loop(self):
+        """
+        Run by the map thread: publish the map for the latest
+        request, at most once every ``T_map_period`` seconds.
+        """
+        while True:
+            self._T_map_pending.wait()
+            self._T_map_pending.clear()
+            try:
+                self._update_T_map(self._T_map_eV)
+            except Exception:
+                logger.exception("Could not update the transmission map")
+            time.sleep(self.T_map_period)
+
+    def transmission_bounds(self, eV, configs):
+        """
+        Monte Carlo confidence bounds of the transmission through
+        each configuration in ``configs`` at photon energy ``eV``.
+
+        Blade thicknesses are perturbed independently, densities and
+        f_2 per material (shared by all blades of that material).  All
+        ``mc_samples`` perturbations of every configuration are
+        evaluated in one batched calculation.
+
+        Returns arrays of lower and upper bounds at ``confidence``.
+        """
+        configs = np.atleast_2d(configs)
+        active = ~np.isnan(configs) & ~np.isnan(self._all_transmissions(eV))
+        blades = [self.blade(i+1) for i in range(self.N_filters)]
+        tau = np.array([b.optical_depth(eV) for b in blades])
+        materials = sorted(set(b._material for b in blades))
+        m = [materials.index(b._material) for b in blades]
+        n = self.mc_samples
+        d_err = np.array([b.thickness_err for b in blades])
+        mu_err = np.hypot([b.density_err for b in blades],
+                          [b.f2_err for b in blades])
+        scale = (1 + self._rng.standard_normal((n, self.N_filters))*d_err)
+        scale *= (1 + self._rng.standard_normal((n, len(materials)))[:, m]
+                  *mu_err)
+        T = np.exp(-(scale*tau) @ active.T)
+        alpha = (1 - self.confidence)/2
+        lower, upper = np.quantile(T, [alpha, 1 - alpha], axis=0)
+        return lower, upper
+
+    def _put_bounds(self, eV, configs, signals):
+        """
+        Publish the confidence bounds of ``configs`` at photon energy
+        ``eV`` to the (lower, upper) signal pairs in ``signals``.
+        """
+        lower, upper = self.transmission_bounds(eV, configs)
+        for (lower_sig, upper_sig), lo, hi in zip(signals, lower, upper):
+            lower_sig.put(lo)
+            upper_sig.put(hi)
+
+    def curr_transmission(self, eV=None, uncertainty=None):
         """
         Calculates and returns transmission at 
         photon energy ``eV`` through current filter configuration.
+
+        With ``uncertainty`` (default ``self.uncertainty``) its
+        confidence bounds are published as well.
         """
         print("updating transmission")
         if not eV:
             eV = self.eV.get()
+        if uncertainty is None:
+            uncertainty = self.uncertainty
         self.transmission = np.nanprod(
             self._all_transmissions(eV)*self._curr_config_arr())
         self.T_actual.put(self.transmission)
+        if uncertainty:
+            self._put_bounds(eV, self.config_arr,
+                             [(self.T_actual_lower, self.T_actual_upper)])
         self.get_3omega_transmission()
         return self.transmission
 
@@ -265,32 +805,77 @@ class HXRSatt(Device):
         To be run every time the ``eV`` signal changes.
         """
         self.transmission = self.curr_transmission(self.eV.get())
+        self._request_T_map(self.eV.get())
 
-    def _T_des_callback(self, value=None, **kwargs):
+    def _update_T_des_limits(self):
         """
-        To be run every time the ``T_des`` signal changes.
+        Solve for the configurations bracketing ``T_des`` at the
+        current photon energy and publish their transmissions.
         """
         config_bestLow, config_bestHigh, T_bestLow, T_bestHigh = self._find_configs(self.eV.get(),
                                                                                     T_des=self.T_des.get())
         self.T_high.put(T_bestHigh)
         self.T_low.put(T_bestLow)
 
+    def _T_des_callback(self, value=None, **kwargs):
+        """
+        To be run every time the ``T_des`` signal changes.
+        """
+        self._update_T_des_limits()
+        if self._moving.is_set():
+            self.request() # Redirect the move in flight.
+
     def _run_callback(self, old_value=None, value=None, **kwargs):
         """
         To be run every time the ``run`` sgianl changes.
         """
-        if old_value == 0 and self.running.get() == 0 and value == 1:
-            print("run value changed to 1, attenuating")
-            self.attenuate()
-            for i in range(self.retries):
-                try:
-                    print("returning run to 0")
-                    self.run.put(0)
-                except Exception:
-                    print("could not set run to 0")
-                    pass
+        if old_value == 0 and value == 1:
+            print("run value changed to 1, queueing request")
+            self.request()
+
+    def request(self):
+        """
+        Queue a move to the current ``T_des``.  Only the newest
+        queued request is acted on, and a move in flight is
+        preempted so that it is redirected to the new target.
+        """
+        self._requests.put(self.T_des.get())
+        if self._moving.is_set():
+            self._preempt.set()
+        self.queue_depth.put(self._requests.qsize())
+
+    def _control_loop(self):
+        """
+        Run by the control thread: wait for requests and attenuate
+        towards the newest one, discarding any it supersedes.
+        """
+        while True:
+            T_des = self._requests.get()
+            while not self._requests.empty():
+                T_des = self._requests.get_nowait()
+            self.queue_depth.put(self._requests.qsize())
+            self._preempt.clear()
+            logger.debug("Attenuating towards %s", T_des)
+            try:
+                self.attenuate(T_des=T_des)
+            except Exception:
+                logger.exception("Attenuation towards %s failed", T_des)
+            if self._requests.empty():
+                self._reset_run()
 
-    def _find_configs(self, eV, T_des=None):
+    def _reset_run(self):
+        """
+        Return the ``run`` signal to 0, retrying on failure.
+        """
+        for i in range(self.retries):
+            try:
+                print("returning run to 0")
+                self.run.put(0)
+                return
+            except Exception:
+                print("could not set run to 0")
+
+    def _find_configs(self, eV, T_des=None, uncertainty=None):
         """
         Find the optimal configurations for attaining
         desired transmission ``T_des`` at photon
@@ -298,30 +883,55 @@ class HXRSatt(Device):
 
         Returns configurations which yield closest
         highest and lowest transmissions and their 
-        transmission values.
+        transmission values.  With ``uncertainty`` (default
+        ``self.uncertainty``) their confidence bounds are published.
         """
         if not T_des:
             T_des = self.T_des.get()
-        T_set = self._all_transmissions(eV)
-        T_table = np.nanprod(T_set*self.config_table,
-                             axis=1)
-        T_config_table = np.asarray(sorted(np.transpose([T_table[:],
-                                    range(len(self.config_table))]),
-                                           key=lambda x: x[0]))
-        i = np.argmin(np.abs(T_config_table[:,0]-T_des))
-        closest = self.config_table[T_config_table[i,1]]
+        if uncertainty is None:
+            uncertainty = self.uncertainty
+        config_bestLow, config_bestHigh, T_bestLow, T_bestHigh = self._solve(eV, T_des)
+        if uncertainty:
+            self._put_bounds(eV, [config_bestLow, config_bestHigh],
+                             [(self.T_low_lower, self.T_low_upper),
+                              (self.T_high_lower, self.T_high_upper)])
+        return config_bestLow, config_bestHigh, T_bestLow, T_bestHigh
+
+    def _solve(self, eV, T_des):
+        """
+        Return the configurations with the closest lower and
+        higher transmission to ``T_des`` at photon energy ``eV``
+        and their transmissions, from the atlas when it is valid.
+        """
+        found = self._atlas_search(eV, T_des) if self._atlas_valid() else None
+        if found is not None:
+            i_low, i_high = found
+            T_set = self._all_transmissions(eV)
+            config_bestLow = self.config_table[i_low]
+            config_bestHigh = self.config_table[i_high]
+            T_bestLow = np.nanprod(T_set*config_bestLow)
+            T_bestHigh = np.nanprod(T_set*config_bestHigh)
+            return config_bestLow, config_bestHigh, T_bestLow, T_bestHigh
+        entry = self._config_transmissions(eV)
+        T_set = entry['T_set']
+        order = entry['order']
+        T_sorted = entry['T_table'][order]
+        i = np.argmin(np.abs(T_sorted-T_des))
+        i_high = min(i+1, len(order)-1)
+        i_low = max(i-1, 0)
+        closest = self.config_table[order[i]]
         T_closest = np.nanprod(T_set*closest)
         if T_closest == T_des:
             config_bestHigh = config_bestLow = closest
             T_bestHigh = T_bestLow = T_closest
         if T_closest < T_des:
-            config_bestHigh = self.config_table[T_config_table[i+1,1]]
+            config_bestHigh = self.config_table[order[i_high]]
             config_bestLow = closest
             T_bestHigh = np.nanprod(T_set*config_bestHigh)
             T_bestLow = T_closest
         if T_closest > T_des:
             config_bestHigh = closest
-            config_bestLow = self.config_table[T_config_table[i-1,1]]
+            config_bestLow = self.config_table[order[i_low]]
             T_bestHigh = T_closest
             T_bestLow = np.nanprod(T_set*config_bestLow)
         return config_bestLow, config_bestHigh, T_bestLow, T_bestHigh
@@ -343,75 +953,86 @@ class HXRSatt(Device):
         self.T_high.put(T_bestHigh)
         return self.T_des.put(T_des)
 
-    def attenuate(self, timeout=None):
+    def _plan_moves(self, eV, to_insert, to_remove, T_floor=None):
+        """
+        Group the blade moves ``to_insert`` and ``to_remove`` into as
+        few concurrent batches as possible at photon energy ``eV``,
+        see ``plan_moves``.  Every plan is verified by ``check_plan``;
+        should one fail, all insertions are done before any removal.
+
+        Returns a list of (insert, remove) lists of blade indices.
+        """
+        if T_floor is None:
+            T_floor = self.T_floor
+        tau = np.array([self.blade(i+1).optical_depth(eV)
+                        for i in range(self.N_filters)])
+        depth = np.nansum(tau*self._curr_config_arr())
+        batches, floor_kept = plan_moves(tau, depth, to_insert, to_remove,
+                                         T_floor)
+        if not check_plan(tau, depth, batches,
+                          T_floor if floor_kept else None):
+            logger.error("Move plan %s failed its safety check, "
+                         "inserting before removing", batches)
+            batches = [(list(to_insert), list()), (list(), list(to_remove))]
+        return batches
+
+    def attenuate(self, timeout=None, T_des=None):
         """
         Will execute the filter selection procedure and
         move the necessary filters into the beam in order
-        to achieve the closest transmission to ``T_des``.
+        to achieve the closest transmission to ``T_des``
+        (default: the ``T_des`` signal).
         """
         print("setting running to high")
         self.running.put(1)
-        config_bestLow, config_bestHigh, T_bestLow, T_bestHigh = self._find_configs(self.eV.get())
-        if self.set_mode.get() == 0:
-            config = config_bestLow
-            T = T_bestLow
-        if self.set_mode.get() == 1:
-            config = config_bestHigh
-            T = T_bestHigh
-        to_insert = list()
-        to_remove = list()
-        for i in range(len(self.config_arr)):
-            blade = self.blade(i+1)
-            if not blade.is_stuck() and blade.removed() and config[i] == 1:
-                to_insert.append(i+1)
-            if not blade.is_stuck() and blade.inserted() and np.isnan(config[i]):
-                to_remove.append(i+1)
-        insert_st = list()
-        in_status = None
-        remove_st = list()
-        out_status = None
-    #        logger.debug("Inserting blades {}".format(to_insert))
-        print("inserting blades")
-        for f in to_insert:
-            insert_st.append(self.insert(f))
-        for st in insert_st:
-            print("waiting on insert status", st)
-            status_wait(st, timeout=timeout)
-        # if len(insert_st) >= 1:
-        #     in_status = insert_st.pop(0)
-        #     for st in insert_st:
-        #         in_status = in_status & st
-            logger.debug("Waiting for motion to finish...")
-#            status_wait(in_status, timeout=timeout)
-        if in_status:
-            inserted = in_status
-        else:
-            inserted = True # Not correct, this should be a status object.
-        # TODO: if any inserted motion fails then do not remove any filters! 
-#        logger.debug("Removing blades {}".format(to_remove))
-        print("removing blades")
-        for f in to_remove:
-            remove_st.append(self.remove(f))
-        if len(remove_st) >= 1:
-            out_status = remove_st.pop(0)
-            for st in remove_st:
-                out_status = out_status & st
-            logger.debug("Waiting for motion to finish...")
-            status_wait(out_status, timeout=timeout)
-        if out_status:
-            removed = out_status
-        else:
-            removed = True
-        self._curr_config_arr()
-        self.curr_transmission()
-        print("resetting running to 0")
-        self.running.put(0)
+        self._moving.set()
+        try:
+            config_bestLow, config_bestHigh, T_bestLow, T_bestHigh = self._find_configs(self.eV.get(), T_des=T_des)
+            if self.set_mode.get() == 0:
+                config = config_bestLow
+                T = T_bestLow
+            if self.set_mode.get() == 1:
+                config = config_bestHigh
+                T = T_bestHigh
+            to_insert = list()
+            to_remove = list()
+            for i in range(len(self.config_arr)):
+                blade = self.blade(i+1)
+                if not blade.is_stuck() and blade.removed() and config[i] == 1:
+                    to_insert.append(i+1)
+                if not blade.is_stuck() and blade.inserted() and np.isnan(config[i]):
+                    to_remove.append(i+1)
+            batches = self._plan_moves(self.eV.get(), to_insert, to_remove)
+            for n, (batch_in, batch_out) in enumerate(batches):
+                if self._preempt.is_set():
+                    # Blades are never stopped mid-travel; the remaining
+                    # batches (all of them, if the request arrived while
+                    # planning) are dropped and the new request is
+                    # planned from here.
+                    print("preempted by a new request, skipping remaining moves")
+                    self._n_preempted += 1
+                    self.preemptions.put(self._n_preempted)
+                    break
+                logger.debug("Batch %s: inserting %s, removing %s",
+                             n, batch_in, batch_out)
+                statuses = ([self.insert(f) for f in batch_in]
+                            + [self.remove(f) for f in batch_out])
+                for st in statuses:
+                    print("waiting on status", st)
+                    status_wait(st, timeout=timeout)
+            self._curr_config_arr()
+            self.curr_transmission()
+        finally:
+            self._moving.clear()
+            print("resetting running to 0")
+            self.running.put(0)
 #        return inserted & removed 
 
 class AT2L0(HXRSatt):
 
     absorption_data = h5py.File('absorption_data.h5', 'r')
     configs = h5py.File('configs.h5', 'r')
+    atlas_file = 'atlas.h5'
 
     f01 = FCpt(HXRFilter, '{prefix}', h5file=absorption_data, 
              index=1, kind='normal')